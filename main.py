@@ -4,16 +4,37 @@ import datetime
 import time
 import random
 import string
-from typing import Any
+import csv
+import io
+import json
+import tempfile
+import gzip
+import hashlib
+import hmac
+import re
+import bisect
+from array import array
+import uuid
+import asyncio
+import sys
+import heapq
+import threading
+import traceback
+from typing import Any, Awaitable, Callable, Iterator
 import discord
 from discord.ext import tasks
+from aiohttp import web
 from riotwatcher import RiotWatcher, LolWatcher, ApiError
 
 
 # --- 設定項目 ---
-DISCORD_TOKEN: str | None = os.getenv('DISCORD_TOKEN')
-RIOT_API_KEY: str | None = os.getenv('RIOT_API_KEY')
-DISCORD_GUILD_ID: int = int(os.getenv('DISCORD_GUILD_ID'))
+# 環境変数由来の設定は create_app() の中で読み込む（import時には読み込まない）
+DISCORD_TOKEN: str | None = None
+RIOT_API_KEY: str | None = None
+DISCORD_GUILD_ID: int | None = None
+EXPORT_HTTP_PORT: int | None = None # 設定した場合のみエクスポート用HTTPサーバーを起動する
+EXPORT_HTTP_HOST: str = '127.0.0.1'
+EXPORT_HTTP_TOKEN: str | None = None # 設定した場合、エクスポートには Authorization: Bearer <token> が必要（ローカル以外で待ち受ける場合は必須）
 DB_PATH: str = '/data/lol_bot.db'
 NOTIFICATION_CHANNEL_ID: int = 1401719055643312219 # 通知用チャンネルID
 HONOR_CHANNEL_ID: int = 1447166222591594607 # 名誉用チャンネルID
@@ -25,6 +46,46 @@ RANK_ROLES: dict[str, str] = {
     "DIAMOND": "LoL Diamond(Solo/Duo)", "MASTER": "LoL Master(Solo/Duo)",
     "GRANDMASTER": "LoL Grandmaster(Solo/Duo)", "CHALLENGER": "LoL Challenger(Solo/Duo)"
 }
+FLEX_RANK_ROLES: dict[str, str] = {
+    "IRON": "LoL Iron(Flex)", "BRONZE": "LoL Bronze(Flex)", "SILVER": "LoL Silver(Flex)",
+    "GOLD": "LoL Gold(Flex)", "PLATINUM": "LoL Platinum(Flex)", "EMERALD": "LoL Emerald(Flex)",
+    "DIAMOND": "LoL Diamond(Flex)", "MASTER": "LoL Master(Flex)",
+    "GRANDMASTER": "LoL Grandmaster(Flex)", "CHALLENGER": "LoL Challenger(Flex)"
+}
+SOLO_QUEUE: str = "RANKED_SOLO_5x5"
+FLEX_QUEUE: str = "RANKED_FLEX_SR"
+QUEUE_NAMES: dict[str, str] = {SOLO_QUEUE: "Solo/Duo", FLEX_QUEUE: "Flex"} # ランキング・統計を表示できるキュー
+QUEUE_RANK_ROLES: dict[str, dict[str, str]] = {SOLO_QUEUE: RANK_ROLES, FLEX_QUEUE: FLEX_RANK_ROLES} # サーバーに存在するロールのみ付与される
+TIER_ORDER: list[str] = ["CHALLENGER", "GRANDMASTER", "MASTER", "DIAMOND", "EMERALD", "PLATINUM", "GOLD", "SILVER", "BRONZE", "IRON"]
+TIER_VALUES: dict[str, int] = {"CHALLENGER": 9, "GRANDMASTER": 8, "MASTER": 7, "DIAMOND": 6, "EMERALD": 5, "PLATINUM": 4, "GOLD": 3, "SILVER": 2, "BRONZE": 1, "IRON": 0}
+RANK_VALUES: dict[str, int] = {"I": 4, "II": 3, "III": 2, "IV": 1}
+RANK_NAMES: dict[int, str] = {value: name for name, value in RANK_VALUES.items()}
+TIER_EMOJIS: dict[str, str] = {
+    "CHALLENGER": "<:challenger:1407917898445357107>",
+    "GRANDMASTER": "<:grandmaster:1407917001401434234>",
+    "MASTER": "<:master:1407917005524176948>",
+    "DIAMOND": "<:diamond:1407916987518156901>",
+    "EMERALD": "<:emerald:1407916989581754458>",
+    "PLATINUM": "<:plat:1407917008611184762>",
+    "GOLD": "<:gold:1407916997303603303>",
+    "SILVER": "<:silver:1407917015884103851>",
+    "BRONZE": "<:bronze:1407917860763992167>",
+    "IRON": "<:iron:1407917003397795901>",
+}
+LOOP_LAG_INTERVAL: float = 0.5 # イベントループ遅延の計測間隔（秒）
+LOOP_STALL_THRESHOLD: float = 0.25 # この秒数以上ループが止まったら停止として記録する
+LOOP_STALL_HISTORY: int = 10 # 保持する停止記録の件数（遅延の大きいものから）
+INTERACTION_QUIET_SECONDS: float = 3.0 # インタラクション受信後、バックグラウンド送信を控える秒数
+BACKGROUND_MAX_DEFER: float = 15.0 # バックグラウンド送信をインタラクションのために待たせる最大秒数
+BACKGROUND_MIN_INTERVAL: float = 0.25 # バックグラウンド送信の最小間隔（秒）
+BACKGROUND_MAX_INTERVAL: float = 5.0 # バックグラウンド送信の最大間隔（秒）
+BACKGROUND_SLOW_CALL: float = 1.0 # この秒数以上かかった送信はレート制限で待たされたとみなす
+NAME_SYNC_INTERVAL_MINUTES: int = 15 # Riot ID同期の実行間隔（分）
+NAME_SYNC_BATCH_SIZE: int = 20 # Riot ID同期で1回に確認するユーザー数
+NAME_SYNC_REQUEST_INTERVAL: float = 1.5 # Riot ID同期のAPI呼び出し間隔（秒）
+HONOR_COOLDOWN_SECONDS: int = 300 # 同じユーザーが続けて名誉を贈れるまでの秒数
+HONOR_LEADERBOARD_SIZE: int = 10
+EXPORT_CHUNK_ROWS: int = 500 # エクスポート時にDBから一度に読み込む行数
 # ----------------
 
 # --- データベースの初期設定 ---
@@ -32,6 +93,8 @@ def setup_database() -> None:
     os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
     con: sqlite3.Connection = sqlite3.connect(DB_PATH)
     cur: sqlite3.Cursor = con.cursor()
+    # WALモードにして、エクスポート中の読み込みが書き込み（登録・ランクチェックなど）をブロックしないようにする（設定はDBファイルに保存される）
+    cur.execute("PRAGMA journal_mode=WAL")
     cur.execute('''
         CREATE TABLE IF NOT EXISTS users (
             discord_id INTEGER PRIMARY KEY,
@@ -50,6 +113,99 @@ def setup_database() -> None:
             notification_channel_id INTEGER NOT NULL
         )
     ''')
+    # キューごとのランク情報（league-v4のレスポンスに含まれる全キュー）
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS queue_ranks (
+            discord_id INTEGER NOT NULL,
+            queue_type TEXT NOT NULL,
+            tier TEXT,
+            rank TEXT,
+            league_points INTEGER,
+            wins INTEGER,
+            losses INTEGER,
+            hot_streak INTEGER,
+            PRIMARY KEY (discord_id, queue_type)
+        )
+    ''')
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_queue_ranks_queue_type ON queue_ranks (queue_type)")
+    # 既存のSolo/Duoランク情報を移行
+    cur.execute("INSERT OR IGNORE INTO queue_ranks (discord_id, queue_type, tier, rank, league_points) SELECT discord_id, ?, tier, rank, league_points FROM users WHERE tier IS NOT NULL",
+                (SOLO_QUEUE,))
+    # 名誉の記録と、受け取った人・期間ごとの集計（記録時に加算する）
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS honors (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            giver_id INTEGER NOT NULL,
+            recipient_id INTEGER,
+            recipient_text TEXT NOT NULL,
+            reason TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )
+    ''')
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_honors_recipient ON honors (recipient_id, created_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_honors_giver ON honors (giver_id, created_at)")
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS honor_counts (
+            period TEXT NOT NULL,
+            recipient_id INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (period, recipient_id)
+        )
+    ''')
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_honor_counts_ranking ON honor_counts (period, count DESC)")
+    # ランクの履歴（ランク情報を保存するたびに追記する）
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS rank_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            discord_id INTEGER NOT NULL,
+            queue_type TEXT NOT NULL,
+            tier TEXT,
+            rank TEXT,
+            league_points INTEGER,
+            wins INTEGER,
+            losses INTEGER,
+            recorded_at TEXT NOT NULL
+        )
+    ''')
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_rank_history_user ON rank_history (discord_id, queue_type, recorded_at)")
+    # 再起動をまたいで保持する小さな状態（最後に投稿したランキングのダイジェストなど）
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS bot_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+    # 定期ランクチェックのチェックポイント（中断時の再開用）
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS refresh_runs (
+            run_id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            started_at TEXT NOT NULL,
+            finished_at TEXT,
+            last_discord_id INTEGER
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS refresh_run_failures (
+            run_id TEXT NOT NULL,
+            discord_id INTEGER NOT NULL,
+            error TEXT,
+            PRIMARY KEY (run_id, discord_id)
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS refresh_run_promotions (
+            run_id TEXT NOT NULL,
+            discord_id INTEGER NOT NULL,
+            game_name TEXT,
+            tag_line TEXT,
+            old_tier TEXT,
+            old_rank TEXT,
+            new_tier TEXT,
+            new_rank TEXT,
+            PRIMARY KEY (run_id, discord_id)
+        )
+    ''')
     con.commit()
     con.close()
 # -----------------------------
@@ -59,11 +215,273 @@ intents: discord.Intents = discord.Intents.default()
 intents.members = True
 bot: discord.Bot = discord.Bot(intents=intents)
 
-riot_watcher: RiotWatcher = RiotWatcher(RIOT_API_KEY)
-lol_watcher: LolWatcher = LolWatcher(RIOT_API_KEY)
+# Riot APIクライアントは初回利用時に作成する
+_riot_watcher: RiotWatcher | None = None
+_lol_watcher: LolWatcher | None = None
 
 my_region_for_account: str = 'asia'
 my_region_for_summoner: str = 'jp1'
+
+def get_riot_watcher() -> RiotWatcher:
+    global _riot_watcher
+    if _riot_watcher is None:
+        _riot_watcher = RiotWatcher(RIOT_API_KEY)
+    return _riot_watcher
+
+def get_lol_watcher() -> LolWatcher:
+    global _lol_watcher
+    if _lol_watcher is None:
+        _lol_watcher = LolWatcher(RIOT_API_KEY)
+    return _lol_watcher
+
+def load_config() -> None:
+    """環境変数から設定を読み込みます。必須の値がない場合はわかりやすいエラーにします。"""
+    global DISCORD_TOKEN, RIOT_API_KEY, DISCORD_GUILD_ID, EXPORT_HTTP_PORT, EXPORT_HTTP_HOST, EXPORT_HTTP_TOKEN
+    missing: list[str] = [name for name in ('DISCORD_TOKEN', 'RIOT_API_KEY', 'DISCORD_GUILD_ID') if not os.getenv(name)]
+    if missing:
+        raise RuntimeError(f"Missing required environment variables: {', '.join(missing)}")
+    DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
+    RIOT_API_KEY = os.getenv('RIOT_API_KEY')
+    DISCORD_GUILD_ID = int(os.getenv('DISCORD_GUILD_ID'))
+    if os.getenv('EXPORT_HTTP_PORT'):
+        EXPORT_HTTP_PORT = int(os.getenv('EXPORT_HTTP_PORT'))
+    EXPORT_HTTP_HOST = os.getenv('EXPORT_HTTP_HOST', EXPORT_HTTP_HOST)
+    EXPORT_HTTP_TOKEN = os.getenv('EXPORT_HTTP_TOKEN') or None
+
+def create_app() -> discord.Bot:
+    """
+    設定の読み込み・DBの初期化・コマンドのギルド登録を行い、起動可能なBotを返します。
+    import時には副作用がないため、テストやベンチマークからはこの関数を呼ばずにモジュールを読み込めます。
+    """
+    load_config()
+    setup_database()
+    for command in bot.pending_application_commands:
+        command.guild_ids = [DISCORD_GUILD_ID]
+    return bot
+# -----------------------------
+
+# --- イベントループ監視 ---
+class LoopWatchdog:
+    """
+    イベントループの遅延(lag)を常時計測し、閾値を超えて停止した場合はループを塞いでいる処理のスタックを記録します。
+    ループ上のハートビートと別スレッドの監視を組み合わせることで、停止中にスタックを取得できます。
+    """
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL, threshold: float = LOOP_STALL_THRESHOLD, history_size: int = LOOP_STALL_HISTORY) -> None:
+        self.interval: float = interval
+        self.threshold: float = threshold
+        self.history_size: int = history_size
+        self.last_lag: float = 0.0
+        self.max_lag: float = 0.0
+        self.stall_count: int = 0
+        self._heartbeat: float = time.monotonic()
+        self._loop_thread_id: int | None = None
+        self._pending_stack: str | None = None
+        self._worst_stalls: list[tuple[float, int, dict[str, Any]]] = [] # 遅延が小さい順のヒープ
+        self._lock: threading.Lock = threading.Lock()
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        if self._task and not self._task.done():
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._task = asyncio.get_running_loop().create_task(self._beat())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    async def _beat(self) -> None:
+        while True:
+            before: float = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now: float = time.monotonic()
+            lag: float = now - before - self.interval
+            with self._lock:
+                self._heartbeat = now
+                stack: str | None = self._pending_stack
+                self._pending_stack = None
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            if lag >= self.threshold:
+                self._record_stall(lag, stack)
+
+    def _watch(self) -> None:
+        # ループが止まっている間にメインスレッドのスタックを取得する（1回の停止につき1回だけ）
+        while True:
+            time.sleep(self.threshold / 2)
+            with self._lock:
+                stalled_for: float = time.monotonic() - self._heartbeat - self.interval
+                if stalled_for < self.threshold or self._pending_stack is not None:
+                    continue
+                frame = sys._current_frames().get(self._loop_thread_id)
+                if frame is not None:
+                    self._pending_stack = "".join(traceback.format_stack(frame))
+
+    def _record_stall(self, lag: float, stack: str | None) -> None:
+        self.stall_count += 1
+        stall: dict[str, Any] = {
+            "lag": lag,
+            "at": datetime.datetime.now(datetime.timezone.utc),
+            "stack": stack or "(stack not captured)",
+        }
+        print(f"!!! Event loop stalled for {lag:.3f}s\n{stall['stack']}")
+        entry: tuple[float, int, dict[str, Any]] = (lag, self.stall_count, stall)
+        if len(self._worst_stalls) < self.history_size:
+            heapq.heappush(self._worst_stalls, entry)
+        elif lag > self._worst_stalls[0][0]:
+            heapq.heapreplace(self._worst_stalls, entry)
+
+    def worst_stalls(self) -> list[dict[str, Any]]:
+        """記録された停止を遅延の大きい順に返します。"""
+        return [stall for _, _, stall in sorted(self._worst_stalls, reverse=True)]
+
+loop_watchdog: LoopWatchdog = LoopWatchdog()
+# -----------------------------
+
+# --- Discord送信スケジューラ ---
+class OutboundScheduler:
+    """
+    Discordへの送信を優先度別に振り分けます。
+    インタラクションへの応答（高優先）はそのまま送信し、その直後の一定時間はバックグラウンド処理（低優先）を待機させます。
+    バックグラウンド処理は1件ずつ直列に実行し、レート制限で応答が遅くなったら送信間隔を広げます。
+    """
+    def __init__(self) -> None:
+        self._interaction_until: float = 0.0
+        self._background_lock: asyncio.Lock = asyncio.Lock()
+        self._interval: float = BACKGROUND_MIN_INTERVAL
+        self._last_background: float = 0.0
+
+    def note_interaction(self) -> None:
+        """インタラクションを受信したことを記録し、応答が終わるまでバックグラウンド処理を止めます。"""
+        self._interaction_until = time.monotonic() + INTERACTION_QUIET_SECONDS
+
+    async def background(self, func: Callable[..., Awaitable[Any]], *args: Any, **kwargs: Any) -> Any:
+        """低優先レーンで func(*args, **kwargs) を実行します。"""
+        async with self._background_lock:
+            # インタラクションの応答中は待機する（ただしバックグラウンド処理が止まり続けないよう上限を設ける）
+            deadline: float = time.monotonic() + BACKGROUND_MAX_DEFER
+            now: float = time.monotonic()
+            while now < self._interaction_until and now < deadline:
+                await asyncio.sleep(min(self._interaction_until, deadline) - now)
+                now = time.monotonic()
+
+            wait: float = self._last_background + self._interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            started: float = time.monotonic()
+            try:
+                result: Any = await func(*args, **kwargs)
+            except discord.HTTPException as e:
+                if e.status == 429:
+                    self._interval = BACKGROUND_MAX_INTERVAL
+                raise
+            else:
+                # py-cordはバケットが枯渇するとリクエスト内部で待機するため、所要時間からバケットの状態を推定する
+                elapsed: float = time.monotonic() - started
+                if elapsed > BACKGROUND_SLOW_CALL:
+                    self._interval = min(self._interval * 2, BACKGROUND_MAX_INTERVAL)
+                else:
+                    self._interval = max(self._interval * 0.75, BACKGROUND_MIN_INTERVAL)
+                return result
+            finally:
+                self._last_background = time.monotonic()
+
+outbound: OutboundScheduler = OutboundScheduler()
+# -----------------------------
+
+# --- データのエクスポート ---
+EXPORT_QUERIES: dict[str, str] = {
+    "users": "SELECT discord_id, riot_puuid, game_name, tag_line, tier, rank, league_points FROM users ORDER BY discord_id",
+    "queue_ranks": "SELECT discord_id, queue_type, tier, rank, league_points, wins, losses, hot_streak FROM queue_ranks ORDER BY discord_id, queue_type",
+    "rank_history": "SELECT id, discord_id, queue_type, tier, rank, league_points, wins, losses, recorded_at FROM rank_history ORDER BY id",
+    "sections": "SELECT role_id, section_name, notification_channel_id FROM sections ORDER BY role_id",
+}
+EXPORT_FORMATS: dict[str, str] = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+def iter_export(dataset: str, fmt: str) -> Iterator[bytes]:
+    """
+    データセットをNDJSONまたはCSVのバイト列としてEXPORT_CHUNK_ROWS行ずつ返します。
+    カーソルから少しずつ読み込むため、行数が多くても結果全体をメモリに載せません。
+    """
+    # 読み取り専用で開く（チャンクごとに別スレッドから読み進められるようにスレッドチェックは外す）
+    con: sqlite3.Connection = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True, check_same_thread=False)
+    try:
+        cur: sqlite3.Cursor = con.execute(EXPORT_QUERIES[dataset])
+        columns: list[str] = [description[0] for description in cur.description]
+        buffer: io.StringIO = io.StringIO()
+        writer = csv.writer(buffer)
+        if fmt == "csv":
+            writer.writerow(columns)
+        while rows := cur.fetchmany(EXPORT_CHUNK_ROWS):
+            if fmt == "csv":
+                writer.writerows(rows)
+            else:
+                for row in rows:
+                    buffer.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False))
+                    buffer.write("\n")
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+        if fmt == "csv" and buffer.tell():
+            yield buffer.getvalue().encode()
+    finally:
+        con.close()
+
+class ExportReader:
+    """
+    iter_export をスレッドから1チャンクずつ読み出します。
+    読み込み中に閉じられても、読み込みが終わるのを待ってからDB接続を閉じます。
+    """
+    def __init__(self, dataset: str, fmt: str) -> None:
+        self._chunks: Iterator[bytes] = iter_export(dataset, fmt)
+        self._lock: threading.Lock = threading.Lock()
+
+    def read_chunk(self) -> bytes | None:
+        with self._lock:
+            return next(self._chunks, None)
+
+    def close(self) -> None:
+        with self._lock:
+            self._chunks.close()
+
+async def handle_export_request(request: web.Request) -> web.StreamResponse:
+    # riot_puuid やDiscord IDを含むため、トークンが設定されていれば照合する
+    if EXPORT_HTTP_TOKEN and not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {EXPORT_HTTP_TOKEN}"):
+        raise web.HTTPUnauthorized(text="Invalid or missing token")
+    dataset: str = request.match_info['dataset']
+    fmt: str = request.query.get('format', 'ndjson')
+    if dataset not in EXPORT_QUERIES:
+        raise web.HTTPNotFound(text=f"Unknown dataset: {dataset}")
+    if fmt not in EXPORT_FORMATS:
+        raise web.HTTPBadRequest(text=f"Unknown format: {fmt}")
+
+    response: web.StreamResponse = web.StreamResponse(headers={"Content-Type": f"{EXPORT_FORMATS[fmt]}; charset=utf-8"})
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+    reader: ExportReader = ExportReader(dataset, fmt)
+    try:
+        # DBの読み込みでイベントループを塞がないよう、チャンクごとにスレッドで読み進める
+        while (chunk := await asyncio.to_thread(reader.read_chunk)) is not None:
+            await response.write(chunk)
+    finally:
+        # クライアントが切断した場合も、読み込み中のチャンクを待ってから接続を閉じる（待つ間ループは塞がない）
+        await asyncio.to_thread(reader.close)
+    await response.write_eof()
+    return response
+
+async def start_export_server() -> None:
+    """読み取り専用のエクスポート用HTTPサーバーを起動します。（EXPORT_HTTP_PORT が未設定なら何もしない）"""
+    if EXPORT_HTTP_PORT is None:
+        return
+    # 認証なしでローカル以外に公開しないよう、トークン未設定ならループバック以外では起動しない
+    if EXPORT_HTTP_HOST not in ('127.0.0.1', '::1', 'localhost') and not EXPORT_HTTP_TOKEN:
+        print(f"!!! Refusing to start export server on {EXPORT_HTTP_HOST}: set EXPORT_HTTP_TOKEN to listen on a non-loopback address")
+        return
+    app: web.Application = web.Application()
+    app.router.add_get("/export/{dataset}", handle_export_request)
+    runner: web.AppRunner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, EXPORT_HTTP_HOST, EXPORT_HTTP_PORT).start()
+    print(f"--- Export server listening on http://{EXPORT_HTTP_HOST}:{EXPORT_HTTP_PORT}/export/<dataset> ---")
 # -----------------------------
 
 # --- UIコンポーネント (View) ---
@@ -86,7 +504,9 @@ class DashboardView(discord.ui.View):
             con: sqlite3.Connection = sqlite3.connect(DB_PATH)
             cur: sqlite3.Cursor = con.cursor()
             cur.execute("DELETE FROM users WHERE discord_id = ?", (interaction.user.id,))
+            cur.execute("DELETE FROM queue_ranks WHERE discord_id = ?", (interaction.user.id,))
             con.commit()
+            remove_from_rosters(interaction.user.id)
 
             if con.total_changes > 0:
                 await interaction.followup.send("あなたの登録情報を削除しました。", ephemeral=True, delete_after=30.0)
@@ -95,7 +515,7 @@ class DashboardView(discord.ui.View):
                 if guild:
                     member: discord.Member | None = await guild.fetch_member(interaction.user.id)
                     if member:
-                        role_names_to_remove: list[discord.Role | None] = [discord.utils.get(guild.roles, name=role_name) for role_name in RANK_ROLES.values()]
+                        role_names_to_remove: list[discord.Role | None] = [discord.utils.get(guild.roles, name=role_name) for rank_roles in QUEUE_RANK_ROLES.values() for role_name in rank_roles.values()]
                         await member.remove_roles(*[role for role in role_names_to_remove if role is not None and role in member.roles])
             else:
                 await interaction.followup.send("あなたはまだ登録されていません。", ephemeral=True, delete_after=30.0)
@@ -163,12 +583,32 @@ class GiveHonorModal(discord.ui.Modal):
         channel: discord.TextChannel | discord.VoiceChannel | discord.Thread | None = bot.get_channel(HONOR_CHANNEL_ID)
         if not channel:
             return
-        embed: discord.Embed = discord.Embed(title=f"名誉投票が行われました", color=discord.Color.gold())
-        embed.description = f"{interaction.user.mention}が名誉を贈りました"
-        embed.add_field(name="名誉を贈りたいユーザー", value=self.children[0].value, inline=False)
-        embed.add_field(name="名誉を贈りたい理由", value=self.children[1].value, inline=False)
-        await channel.send(embed=embed)
-        await interaction.followup.send(f"「{self.children[0].value}」に名誉を贈りました！", ephemeral=True, delete_after=30.0)
+
+        recipient: discord.Member | None = resolve_member(interaction.guild, self.children[0].value) if interaction.guild else None
+        if recipient and recipient.id == interaction.user.id:
+            await interaction.followup.send("自分自身に名誉を贈ることはできません。", ephemeral=True, delete_after=30.0)
+            return
+        if recipient and recipient.bot:
+            await interaction.followup.send("ボットに名誉を贈ることはできません。", ephemeral=True, delete_after=30.0)
+            return
+
+        try:
+            remaining_seconds: int = get_honor_cooldown_remaining(interaction.user.id)
+            if remaining_seconds > 0:
+                await interaction.followup.send(f"続けて名誉を贈るには、あと{remaining_seconds}秒お待ちください。", ephemeral=True, delete_after=30.0)
+                return
+
+            record_honor(interaction.user.id, recipient.id if recipient else None, self.children[0].value, self.children[1].value)
+
+            embed: discord.Embed = discord.Embed(title=f"名誉投票が行われました", color=discord.Color.gold())
+            embed.description = f"{interaction.user.mention}が名誉を贈りました"
+            embed.add_field(name="名誉を贈りたいユーザー", value=recipient.mention if recipient else self.children[0].value, inline=False)
+            embed.add_field(name="名誉を贈りたい理由", value=self.children[1].value, inline=False)
+            await channel.send(embed=embed)
+            await interaction.followup.send(f"「{self.children[0].value}」に名誉を贈りました！", ephemeral=True, delete_after=30.0)
+        except Exception as e:
+            print(f"!!! An unexpected error occurred in 'GiveHonorModal' callback: {e}")
+            await interaction.followup.send("名誉を贈る処理中に予期せぬエラーが発生しました。", ephemeral=True, delete_after=30.0)
 
 class RegisterModal(discord.ui.Modal):
     def __init__(self) -> None:
@@ -186,20 +626,26 @@ class RegisterModal(discord.ui.Modal):
         tag_line = tag_line.upper()
 
         try:
-            account_info: dict[str, Any] = riot_watcher.account.by_riot_id(my_region_for_account, game_name, tag_line)
+            account_info: dict[str, Any] = get_riot_watcher().account.by_riot_id(my_region_for_account, game_name, tag_line)
             puuid: str = account_info['puuid']
-            rank_info: dict[str, Any] | None = get_rank_by_puuid(puuid)
+            ranks: dict[str, dict[str, Any]] = get_ranks_by_puuid(puuid)
+            rank_info: dict[str, Any] | None = ranks.get(SOLO_QUEUE)
 
             con: sqlite3.Connection = sqlite3.connect(DB_PATH)
             cur: sqlite3.Cursor = con.cursor()
+            previous_discord_id: int | None = release_puuid(cur, puuid, interaction.user.id)
             if rank_info:
                 cur.execute("INSERT OR REPLACE INTO users (discord_id, riot_puuid, game_name, tag_line, tier, rank, league_points) VALUES (?, ?, ?, ?, ?, ?, ?)",
                             (interaction.user.id, puuid, game_name, tag_line, rank_info['tier'], rank_info['rank'], rank_info['leaguePoints']))
             else:
                 cur.execute("INSERT OR REPLACE INTO users (discord_id, riot_puuid, game_name, tag_line, tier, rank, league_points) VALUES (?, ?, ?, ?, NULL, NULL, NULL)",
                             (interaction.user.id, puuid, game_name, tag_line))
+            save_queue_ranks(cur, interaction.user.id, ranks)
             con.commit()
             con.close()
+            update_rosters(interaction.user.id, ranks)
+            if previous_discord_id is not None:
+                remove_from_rosters(previous_discord_id)
             await interaction.followup.send(f"Riot ID「{game_name}#{tag_line}」を登録しました！", ephemeral=True, delete_after=30.0)
         except ApiError as err:
             if err.response.status_code == 404:
@@ -297,65 +743,296 @@ class RemoveSectionSelect(discord.ui.Select):
             await interaction.response.edit_message(content="セクションからの退出中にエラーが発生しました。", view=None)
 
 # --- ヘルパー関数 ---
-def get_rank_by_puuid(puuid: str) -> dict[str, Any] | None:
+def get_ranks_by_puuid(puuid: str) -> dict[str, dict[str, Any]]:
+    """league-v4のレスポンスに含まれる全キューのランク情報を {queueType: ランク情報} で返します。"""
     max_retries: int = 3
+    last_error: ApiError | None = None
     for attempt in range(max_retries):
         try:
             # LEAGUE-V4のby-puuidエンドポイントを直接呼び出す
-            ranked_stats: list[dict[str, Any]] = lol_watcher.league.by_puuid(my_region_for_summoner, puuid)
-
-            # ranked_statsはリスト形式であるため、ループで処理する
-            for queue in ranked_stats:
-                if queue.get("queueType") == "RANKED_SOLO_5x5":
-                    # Solo/Duoランク情報が見つかった場合
-                    return {
-                        "tier": queue.get("tier"),
-                        "rank": queue.get("rank"),
-                        "leaguePoints": queue.get("leaguePoints")
-                    }
-
-            # リスト内にSolo/Duoランク情報がなかった場合
-            return None
+            ranked_stats: list[dict[str, Any]] = get_lol_watcher().league.by_puuid(my_region_for_summoner, puuid)
+
+            # ranked_statsはリスト形式であるため、キューごとに振り分ける
+            return {
+                queue["queueType"]: {
+                    "tier": queue.get("tier"),
+                    "rank": queue.get("rank"),
+                    "leaguePoints": queue.get("leaguePoints"),
+                    "wins": queue.get("wins"),
+                    "losses": queue.get("losses"),
+                    "hotStreak": queue.get("hotStreak")
+                }
+                for queue in ranked_stats if queue.get("queueType")
+            }
 
         except ApiError as err:
             if err.response.status_code == 429:
+                last_error = err
                 retry_after: int = int(err.response.headers.get('Retry-After', 1))
                 print(f"Rate limit exceeded. Retrying after {retry_after} seconds... (Attempt {attempt + 1}/{max_retries})")
                 time.sleep(retry_after)
                 continue
             elif err.response.status_code == 404:
                 # ユーザーにランク情報がない場合
-                return None
+                return {}
             else:
                 # 400 Bad Requestなど、その他のAPIエラー
-                print(f"API Error in get_rank_by_puuid for PUUID {puuid}: {err}")
+                print(f"API Error in get_ranks_by_puuid for PUUID {puuid}: {err}")
                 raise
         except Exception as e:
             # 予期せぬエラー
-            print(f"An unexpected error occurred in get_rank_by_puuid for PUUID {puuid}: {e}")
+            print(f"An unexpected error occurred in get_ranks_by_puuid for PUUID {puuid}: {e}")
             raise
 
-    # リトライにすべて失敗した場合
+    # リトライにすべて失敗した場合は、ランクなしと区別できるよう例外にする
     print(f"Failed to get rank for PUUID {puuid} after {max_retries} retries.")
-    return None
+    raise last_error
+
+def release_puuid(cur: sqlite3.Cursor, puuid: str, discord_id: int) -> int | None:
+    """
+    同じPUUIDが別のDiscordユーザーに登録されていれば、そのユーザーの登録を削除してIDを返します。
+    INSERT OR REPLACE による暗黙の削除ではqueue_ranksや名簿が残ってしまうため、事前に明示的に削除します。（コミットは呼び出し側で行う）
+    """
+    cur.execute("SELECT discord_id FROM users WHERE riot_puuid = ? AND discord_id != ?", (puuid, discord_id))
+    result: tuple[int] | None = cur.fetchone()
+    if not result:
+        return None
+    cur.execute("DELETE FROM users WHERE discord_id = ?", (result[0],))
+    cur.execute("DELETE FROM queue_ranks WHERE discord_id = ?", (result[0],))
+    return result[0]
+
+def save_queue_ranks(cur: sqlite3.Cursor, discord_id: int, ranks: dict[str, dict[str, Any]]) -> None:
+    """ユーザーのキューごとのランク情報を置き換え、変化したキューのみ履歴に追記します。（コミットは呼び出し側で行う）"""
+    cur.execute("SELECT queue_type, tier, rank, league_points, wins, losses FROM queue_ranks WHERE discord_id = ?", (discord_id,))
+    previous_ranks: dict[str, tuple[Any, ...]] = {row[0]: row[1:] for row in cur.fetchall()}
+    cur.execute("DELETE FROM queue_ranks WHERE discord_id = ?", (discord_id,))
+    cur.executemany(
+        "INSERT INTO queue_ranks (discord_id, queue_type, tier, rank, league_points, wins, losses, hot_streak) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        [(discord_id, queue_type, info['tier'], info['rank'], info['leaguePoints'], info['wins'], info['losses'], info['hotStreak'])
+         for queue_type, info in ranks.items()]
+    )
+    recorded_at: str = datetime.datetime.now(jst).isoformat()
+    cur.executemany(
+        "INSERT INTO rank_history (discord_id, queue_type, tier, rank, league_points, wins, losses, recorded_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        [(discord_id, queue_type, info['tier'], info['rank'], info['leaguePoints'], info['wins'], info['losses'], recorded_at)
+         for queue_type, info in ranks.items()
+         if previous_ranks.get(queue_type) != (info['tier'], info['rank'], info['leaguePoints'], info['wins'], info['losses'])]
+    )
+
+def resolve_member(guild: discord.Guild, text: str) -> discord.Member | None:
+    """メンション・ユーザーID・ユーザー名（表示名）のいずれかからサーバーのメンバーを探します。"""
+    text = text.strip()
+    match: re.Match[str] | None = re.fullmatch(r"<@!?(\d+)>|(\d+)", text)
+    if match:
+        return guild.get_member(int(match.group(1) or match.group(2)))
+    return guild.get_member_named(text.removeprefix("@"))
+
+def get_honor_cooldown_remaining(giver_id: int) -> int:
+    """名誉を贈れるようになるまでの残り秒数を返します。"""
+    con: sqlite3.Connection = sqlite3.connect(DB_PATH)
+    cur: sqlite3.Cursor = con.cursor()
+    cur.execute("SELECT MAX(created_at) FROM honors WHERE giver_id = ?", (giver_id,))
+    last_given_at: str | None = cur.fetchone()[0]
+    con.close()
+    if not last_given_at:
+        return 0
+    elapsed: float = (datetime.datetime.now(jst) - datetime.datetime.fromisoformat(last_given_at)).total_seconds()
+    return max(0, int(HONOR_COOLDOWN_SECONDS - elapsed))
+
+def record_honor(giver_id: int, recipient_id: int | None, recipient_text: str, reason: str) -> None:
+    """名誉を記録し、受け取った人の累計・月間の集計を加算します。"""
+    now: datetime.datetime = datetime.datetime.now(jst)
+    con: sqlite3.Connection = sqlite3.connect(DB_PATH)
+    cur: sqlite3.Cursor = con.cursor()
+    cur.execute("INSERT INTO honors (giver_id, recipient_id, recipient_text, reason, created_at) VALUES (?, ?, ?, ?, ?)",
+                (giver_id, recipient_id, recipient_text, reason, now.isoformat()))
+    # メンバーを特定できなかった名誉は記録のみで集計しない
+    if recipient_id is not None:
+        cur.executemany(
+            "INSERT INTO honor_counts (period, recipient_id, count) VALUES (?, ?, 1) ON CONFLICT (period, recipient_id) DO UPDATE SET count = count + 1",
+            [("all", recipient_id), (now.strftime("%Y-%m"), recipient_id)]
+        )
+    con.commit()
+    con.close()
 
 def rank_to_value(tier: str, rank: str, lp: int) -> int:
-    tier_values: dict[str, int] = {"CHALLENGER": 9, "GRANDMASTER": 8, "MASTER": 7, "DIAMOND": 6, "EMERALD": 5, "PLATINUM": 4, "GOLD": 3, "SILVER": 2, "BRONZE": 1, "IRON": 0}
-    rank_values: dict[str, int] = {"I": 4, "II": 3, "III": 2, "IV": 1}
-    tier_val: int = tier_values.get(tier.upper(), 0) * 1000
-    rank_val: int = rank_values.get(rank.upper(), 0) * 100
+    tier_val: int = TIER_VALUES.get(tier.upper(), 0) * 1000
+    rank_val: int = RANK_VALUES.get(rank.upper(), 0) * 100
     return tier_val + rank_val + lp
 
+# --- ランク集計（ロスター） ---
+class Roster:
+    """
+    ランク情報を列ごとのarrayで保持するメモリ上の名簿です。
+    起動時にDBから一度だけ読み込み、以降はDBへの書き込みと同時に update / remove を呼んで同期させます。
+    """
+    def __init__(self, queue_type: str = SOLO_QUEUE) -> None:
+        self.queue_type: str = queue_type
+        self.loaded: bool = False
+        self._clear()
+
+    def _clear(self) -> None:
+        self.discord_ids: array = array('q')
+        self.tiers: array = array('b') # TIER_VALUES の値
+        self.divisions: array = array('b') # RANK_VALUES の値
+        self.lps: array = array('l')
+        self.values: array = array('l') # rank_to_value の値
+        self._positions: dict[int, int] = {}
+        self._tier_counts: array = array('l', [0] * len(TIER_VALUES))
+        self._order: array | None = None # valueの昇順に並べた位置（変更があるまでキャッシュ）
+        self._sorted_values: array | None = None
+
+    def __len__(self) -> int:
+        return len(self.discord_ids)
+
+    def load(self) -> None:
+        self._clear()
+        con: sqlite3.Connection = sqlite3.connect(DB_PATH)
+        cur: sqlite3.Cursor = con.cursor()
+        if self.queue_type == SOLO_QUEUE:
+            cur.execute("SELECT discord_id, tier, rank, league_points FROM users WHERE tier IS NOT NULL AND rank IS NOT NULL")
+        else:
+            cur.execute("SELECT discord_id, tier, rank, league_points FROM queue_ranks WHERE queue_type = ? AND tier IS NOT NULL AND rank IS NOT NULL",
+                        (self.queue_type,))
+        for discord_id, tier, rank, lp in cur:
+            self._set(discord_id, tier, rank, lp)
+        con.close()
+        self.loaded = True
+
+    def update(self, discord_id: int, rank_info: dict[str, Any] | None) -> None:
+        """get_ranks_by_puuid が返す1キュー分のランク情報で更新します。Noneの場合は名簿から外します。"""
+        if rank_info:
+            self._set(discord_id, rank_info['tier'], rank_info['rank'], rank_info['leaguePoints'])
+        else:
+            self.remove(discord_id)
+
+    def _set(self, discord_id: int, tier: str, rank: str, lp: int | None) -> None:
+        tier_val: int = TIER_VALUES.get(tier.upper(), 0)
+        lp = lp or 0
+        pos: int | None = self._positions.get(discord_id)
+        if pos is None:
+            self._positions[discord_id] = len(self.discord_ids)
+            self.discord_ids.append(discord_id)
+            self.tiers.append(tier_val)
+            self.divisions.append(RANK_VALUES.get(rank.upper(), 0))
+            self.lps.append(lp)
+            self.values.append(rank_to_value(tier, rank, lp))
+        else:
+            self._tier_counts[self.tiers[pos]] -= 1
+            self.tiers[pos] = tier_val
+            self.divisions[pos] = RANK_VALUES.get(rank.upper(), 0)
+            self.lps[pos] = lp
+            self.values[pos] = rank_to_value(tier, rank, lp)
+        self._tier_counts[tier_val] += 1
+        self._order = None
+        self._sorted_values = None
+
+    def remove(self, discord_id: int) -> None:
+        pos: int | None = self._positions.pop(discord_id, None)
+        if pos is None:
+            return
+        self._tier_counts[self.tiers[pos]] -= 1
+        # 末尾の要素を削除位置へ移してから末尾を落とす
+        last: int = len(self.discord_ids) - 1
+        for column in (self.discord_ids, self.tiers, self.divisions, self.lps, self.values):
+            column[pos] = column[last]
+            column.pop()
+        if pos != last:
+            self._positions[self.discord_ids[pos]] = pos
+        self._order = None
+        self._sorted_values = None
+
+    def _sorted(self) -> tuple[array, array]:
+        if self._order is None or self._sorted_values is None:
+            self._order = array('l', sorted(range(len(self.values)), key=self.values.__getitem__))
+            self._sorted_values = array('l', (self.values[pos] for pos in self._order))
+        return self._order, self._sorted_values
+
+    def label(self, pos: int) -> str:
+        tier: str = TIER_ORDER[len(TIER_ORDER) - 1 - self.tiers[pos]]
+        division: str = RANK_NAMES.get(self.divisions[pos], "")
+        return f"{tier} {division} / {self.lps[pos]}LP"
+
+    def tier_distribution(self) -> list[tuple[str, int]]:
+        """上位ティアから順に (ティア名, 人数) を返します。"""
+        return [(tier, self._tier_counts[TIER_VALUES[tier]]) for tier in TIER_ORDER]
+
+    def percentile_label(self, percentile: float) -> str | None:
+        """指定したパーセンタイル（0〜100、低いほど下位）に位置するプレイヤーのランク表記を返します。"""
+        if not self.discord_ids:
+            return None
+        order, _ = self._sorted()
+        index: int = round(percentile / 100 * (len(order) - 1))
+        return self.label(order[index])
+
+    def standing(self, discord_id: int) -> tuple[int, float] | None:
+        """(サーバー内順位, パーセンタイル) を返します。未登録またはランク情報がない場合はNone。"""
+        pos: int | None = self._positions.get(discord_id)
+        if pos is None:
+            return None
+        _, sorted_values = self._sorted()
+        value: int = self.values[pos]
+        server_rank: int = len(sorted_values) - bisect.bisect_right(sorted_values, value) + 1
+        percentile: float = bisect.bisect_left(sorted_values, value) / len(sorted_values) * 100
+        return server_rank, percentile
+
+rosters: dict[str, Roster] = {queue_type: Roster(queue_type) for queue_type in QUEUE_NAMES}
+
+def update_rosters(discord_id: int, ranks: dict[str, dict[str, Any]]) -> None:
+    for queue_type, queue_roster in rosters.items():
+        queue_roster.update(discord_id, ranks.get(queue_type))
+
+def remove_from_rosters(discord_id: int) -> None:
+    for queue_roster in rosters.values():
+        queue_roster.remove(discord_id)
+
+def get_bot_state(key: str) -> str | None:
+    con: sqlite3.Connection = sqlite3.connect(DB_PATH)
+    cur: sqlite3.Cursor = con.cursor()
+    cur.execute("SELECT value FROM bot_state WHERE key = ?", (key,))
+    result: tuple[str] | None = cur.fetchone()
+    con.close()
+    return result[0] if result else None
+
+def set_bot_state(key: str, value: str) -> None:
+    con: sqlite3.Connection = sqlite3.connect(DB_PATH)
+    cur: sqlite3.Cursor = con.cursor()
+    cur.execute("INSERT OR REPLACE INTO bot_state (key, value) VALUES (?, ?)", (key, value))
+    con.commit()
+    con.close()
+
+def ranking_digest() -> str:
+    """ランキングに表示される内容のダイジェストを返します。内容が変わっていなければ同じ値になります。"""
+    con: sqlite3.Connection = sqlite3.connect(DB_PATH)
+    cur: sqlite3.Cursor = con.cursor()
+    cur.execute("SELECT discord_id, game_name, tag_line, tier, rank, league_points FROM users WHERE tier IS NOT NULL AND rank IS NOT NULL ORDER BY discord_id")
+    digest = hashlib.sha256()
+    for row in cur:
+        digest.update(repr(row).encode())
+    con.close()
+    return digest.hexdigest()
+
 # --- ランキング作成ロジックを共通関数化 ---
-async def create_ranking_embed() -> discord.Embed:
+async def create_ranking_embed(queue_type: str = SOLO_QUEUE, background: bool = True) -> discord.Embed:
+    """
+    ランキングのEmbedを作成します。
+    background=True（定期投稿・起動時投稿）の場合、キャッシュにないユーザーの取得は低優先レーンで行います。
+    """
     con: sqlite3.Connection = sqlite3.connect(DB_PATH)
     cur: sqlite3.Cursor = con.cursor()
     # DBからランク情報がNULLでないユーザーのみを取得
-    cur.execute("SELECT discord_id, game_name, tag_line, tier, rank, league_points FROM users WHERE tier IS NOT NULL AND rank IS NOT NULL")
+    if queue_type == SOLO_QUEUE:
+        cur.execute("SELECT discord_id, game_name, tag_line, tier, rank, league_points FROM users WHERE tier IS NOT NULL AND rank IS NOT NULL")
+    else:
+        cur.execute('''
+            SELECT u.discord_id, u.game_name, u.tag_line, q.tier, q.rank, q.league_points FROM queue_ranks q
+            JOIN users u ON u.discord_id = q.discord_id
+            WHERE q.queue_type = ? AND q.tier IS NOT NULL AND q.rank IS NOT NULL
+        ''', (queue_type,))
     registered_users_with_rank: list[tuple[int, str, str, str, str, int]] = cur.fetchall()
     con.close()
 
-    embed: discord.Embed = discord.Embed(title="🏆 ぱぶびゅ！内LoL(Solo/Duo)ランキング 🏆", color=discord.Color.gold())
+    embed: discord.Embed = discord.Embed(title=f"🏆 ぱぶびゅ！内LoL({QUEUE_NAMES[queue_type]})ランキング 🏆", color=discord.Color.gold())
 
     description_footer: str = "\n\n**`/register` コマンドであなたもランキングに参加しよう！**"
     description_update_time: str = "（ランキングは毎日正午に自動更新されます）"
@@ -377,18 +1054,6 @@ async def create_ranking_embed() -> discord.Embed:
     embed.description = f"現在登録されているメンバーのランクです。\n{description_update_time}{description_footer}"
 
     previous_tier: str = ""
-    role_emojis: dict[str, str] = {
-        "CHALLENGER": "<:challenger:1407917898445357107>",
-        "GRANDMASTER": "<:grandmaster:1407917001401434234>",
-        "MASTER": "<:master:1407917005524176948>",
-        "DIAMOND": "<:diamond:1407916987518156901>",
-        "EMERALD": "<:emerald:1407916989581754458>",
-        "PLATINUM": "<:plat:1407917008611184762>",
-        "GOLD": "<:gold:1407916997303603303>",
-        "SILVER": "<:silver:1407917015884103851>",
-        "BRONZE": "<:bronze:1407917860763992167>",
-        "IRON": "<:iron:1407917003397795901>",
-    }
 
     # ティアごとにプレイヤーをグループ化
     players_by_tier: dict[str, list[dict[str, Any]]] = {}
@@ -398,27 +1063,24 @@ async def create_ranking_embed() -> discord.Embed:
             players_by_tier[tier] = []
         players_by_tier[tier].append(player)
 
-    # ティアの順序を定義
-    tier_order: list[str] = ["CHALLENGER", "GRANDMASTER", "MASTER", "DIAMOND", "EMERALD", "PLATINUM", "GOLD", "SILVER", "BRONZE", "IRON"]
-
     # ティアごとにフィールドを追加
     rank_counter: int = 1
-    for tier in tier_order:
+    for tier in TIER_ORDER:
         if tier in players_by_tier:
             tier_players: list[dict[str, Any]] = players_by_tier[tier]
             field_value: str = ""
             for player in tier_players:
-                try:
-                    user: discord.User = await bot.fetch_user(player['discord_id'])
-                    mention_name: str = user.mention
-                except discord.NotFound:
-                    # サーバーにいないユーザーは display_name を使う（取得できない場合は'N/A'）
+                # まずキャッシュから探し、見つからない場合のみAPIで取得する（取得できない場合は'N/A'）
+                user: discord.User | None = bot.get_user(player['discord_id'])
+                if user is None:
                     try:
-                        user: discord.User = await bot.fetch_user(player['discord_id'])
-                        mention_name: str = user.display_name
-                    except:
-                        mention_name: str = "N/A"
-
+                        if background:
+                            user = await outbound.background(bot.fetch_user, player['discord_id'])
+                        else:
+                            user = await bot.fetch_user(player['discord_id'])
+                    except discord.NotFound:
+                        user = None
+                mention_name: str = user.mention if user else "N/A"
 
                 riot_id_full: str = f"{player['game_name']}#{player['tag_line'].upper()}"
                 # ランク情報の太字を解除
@@ -437,7 +1099,7 @@ async def create_ranking_embed() -> discord.Embed:
                 padding_count: int = max(0, base_length - header_core_length)
                 padding: str = "─" * padding_count
 
-                header_text: str = f"{role_emojis[tier]} {tier} {role_emojis[tier]} {padding}"
+                header_text: str = f"{TIER_EMOJIS[tier]} {tier} {TIER_EMOJIS[tier]} {padding}"
 
                 embed.add_field(
                     name=f"**{header_text}**",
@@ -449,10 +1111,16 @@ async def create_ranking_embed() -> discord.Embed:
 
 # --- イベント ---
 _startup_done: bool = False
+_deferred_startup_task: asyncio.Task | None = None # 起動時の後回し処理（タスクが途中で破棄されないよう参照を保持）
+
+@bot.listen("on_interaction")
+async def prioritize_interaction(interaction: discord.Interaction) -> None:
+    # インタラクションの応答を優先するため、バックグラウンド送信を一時的に控える
+    outbound.note_interaction()
 
 @bot.event
 async def on_ready() -> None:
-    global _startup_done
+    global _startup_done, _deferred_startup_task
     print(f"Bot logged in as {bot.user}")
 
     # on_readyは再接続のたびに発火するため、初回起動時のみ初期化処理を実行
@@ -461,41 +1129,92 @@ async def on_ready() -> None:
         return
     _startup_done = True
 
-    # Bot起動時に永続Viewを登録
+    # Bot起動時に永続Viewを登録（ダッシュボードのボタンにすぐ応答できるよう最初に行う）
     bot.add_view(DashboardView())
-    # ▼▼▼ 起動時にランキングを投稿する処理を追加 ▼▼▼
-    print("--- Posting initial ranking on startup ---")
+
+    # イベントループの停止監視とバックグラウンドタスクを開始
+    loop_watchdog.start()
+    if not check_ranks_periodically.is_running():
+        check_ranks_periodically.start()
+    if not sync_riot_ids.is_running():
+        sync_riot_ids.start()
+
+    # 時間のかかる処理は後回しにして、on_readyはすぐに終える
+    _deferred_startup_task = bot.loop.create_task(run_deferred_startup())
+    print("--- Ready ---")
+
+async def run_deferred_startup() -> None:
+    # 各処理が失敗しても（ポート使用中・APIエラーなど）、以降の起動処理は続ける
+    # エクスポート用サーバーを起動
+    try:
+        await start_export_server()
+    except Exception as e:
+        print(f"!!! Failed to start export server on {EXPORT_HTTP_HOST}:{EXPORT_HTTP_PORT}: {e}")
+
+    # ランク集計用の名簿をDBから読み込む（/stats は未読み込みでも自分で読み込む）
+    try:
+        for queue_roster in rosters.values():
+            if not queue_roster.loaded:
+                queue_roster.load()
+    except Exception as e:
+        print(f"!!! Failed to load rank rosters on startup: {e}")
+
+    # 前回のランクチェックが再起動などで中断されていれば、続きから再開する
+    try:
+        await resume_interrupted_refresh()
+    except Exception as e:
+        print(f"!!! Failed to resume interrupted rank check: {e}")
+
+    # ▼▼▼ 起動時にランキングを投稿する処理 ▼▼▼
+    try:
+        await post_startup_ranking()
+    except Exception as e:
+        print(f"!!! Failed to post initial ranking on startup: {e}")
+
+async def post_startup_ranking() -> None:
+    # 前回投稿したランキングから変化がなければ投稿しない
+    digest: str = ranking_digest()
+    if get_bot_state('last_ranking_digest') == digest:
+        print("--- Ranking unchanged since last post (skipping initial ranking) ---")
+        return
     channel: discord.TextChannel | discord.VoiceChannel | discord.Thread | None = bot.get_channel(NOTIFICATION_CHANNEL_ID)
     if channel:
+        print("--- Posting initial ranking on startup ---")
         ranking_embed: discord.Embed = await create_ranking_embed()
         if ranking_embed:
-            await channel.send("【起動時ランキング速報】", embed=ranking_embed)
-
-    if not check_ranks_periodically.is_running():
-        check_ranks_periodically.start()
+            await outbound.background(channel.send, "【起動時ランキング速報】", embed=ranking_embed)
+            set_bot_state('last_ranking_digest', digest)
 
 # --- コマンド ---
-@bot.slash_command(name="register", description="あなたのRiot IDをボットに登録します。", guild_ids=[DISCORD_GUILD_ID])
+QUEUE_CHOICES: list[discord.OptionChoice] = [discord.OptionChoice(name=name, value=queue_type) for queue_type, name in QUEUE_NAMES.items()]
+
+@bot.slash_command(name="register", description="あなたのRiot IDをボットに登録します。")
 async def register(ctx: discord.ApplicationContext, game_name: str, tag_line: str) -> None:
     await ctx.defer()
     if tag_line.startswith("#"):
         tag_line = tag_line[1:]
     tag_line = tag_line.upper()
     try:
-        account_info: dict[str, Any] = riot_watcher.account.by_riot_id(my_region_for_account, game_name, tag_line)
+        account_info: dict[str, Any] = get_riot_watcher().account.by_riot_id(my_region_for_account, game_name, tag_line)
         puuid: str = account_info['puuid']
-        rank_info: dict[str, Any] | None = get_rank_by_puuid(puuid)
+        ranks: dict[str, dict[str, Any]] = get_ranks_by_puuid(puuid)
+        rank_info: dict[str, Any] | None = ranks.get(SOLO_QUEUE)
 
         con: sqlite3.Connection = sqlite3.connect(DB_PATH)
         cur: sqlite3.Cursor = con.cursor()
+        previous_discord_id: int | None = release_puuid(cur, puuid, ctx.author.id)
         if rank_info:
             cur.execute("INSERT OR REPLACE INTO users (discord_id, riot_puuid, game_name, tag_line, tier, rank, league_points) VALUES (?, ?, ?, ?, ?, ?, ?)",
                         (ctx.author.id, puuid, game_name, tag_line, rank_info['tier'], rank_info['rank'], rank_info['leaguePoints']))
         else:
             cur.execute("INSERT OR REPLACE INTO users (discord_id, riot_puuid, game_name, tag_line, tier, rank, league_points) VALUES (?, ?, ?, ?, NULL, NULL, NULL)",
                         (ctx.author.id, puuid, game_name, tag_line))
+        save_queue_ranks(cur, ctx.author.id, ranks)
         con.commit()
         con.close()
+        update_rosters(ctx.author.id, ranks)
+        if previous_discord_id is not None:
+            remove_from_rosters(previous_discord_id)
         await ctx.respond(f"Riot ID「{game_name}#{tag_line}」を登録しました！")
     except ApiError as err:
         if err.response.status_code == 404:
@@ -506,7 +1225,7 @@ async def register(ctx: discord.ApplicationContext, game_name: str, tag_line: st
         print(f"!!! An unexpected error occurred in 'register' command: {e}")
         await ctx.respond("登録中に予期せぬエラーが発生しました。")
 
-@bot.slash_command(name="register_by_other", description="指定したユーザーのRiot IDをボットに登録します。（管理者向け）", guild_ids=[DISCORD_GUILD_ID])
+@bot.slash_command(name="register_by_other", description="指定したユーザーのRiot IDをボットに登録します。（管理者向け）")
 @discord.default_permissions(administrator=True)
 async def register_by_other(ctx: discord.ApplicationContext, user: discord.Member, game_name: str, tag_line: str) -> None:
     await ctx.defer(ephemeral=True) # コマンド結果は実行者のみに見える
@@ -514,21 +1233,27 @@ async def register_by_other(ctx: discord.ApplicationContext, user: discord.Membe
         tag_line = tag_line[1:]
     tag_line = tag_line.upper()
     try:
-        account_info: dict[str, Any] = riot_watcher.account.by_riot_id(my_region_for_account, game_name, tag_line)
+        account_info: dict[str, Any] = get_riot_watcher().account.by_riot_id(my_region_for_account, game_name, tag_line)
         puuid: str = account_info['puuid']
-        rank_info: dict[str, Any] | None = get_rank_by_puuid(puuid)
+        ranks: dict[str, dict[str, Any]] = get_ranks_by_puuid(puuid)
+        rank_info: dict[str, Any] | None = ranks.get(SOLO_QUEUE)
 
         con: sqlite3.Connection = sqlite3.connect(DB_PATH)
         cur: sqlite3.Cursor = con.cursor()
         target_discord_id: int = user.id
+        previous_discord_id: int | None = release_puuid(cur, puuid, target_discord_id)
         if rank_info:
             cur.execute("INSERT OR REPLACE INTO users (discord_id, riot_puuid, game_name, tag_line, tier, rank, league_points) VALUES (?, ?, ?, ?, ?, ?, ?)",
                         (target_discord_id, puuid, game_name, tag_line, rank_info['tier'], rank_info['rank'], rank_info['leaguePoints']))
         else:
             cur.execute("INSERT OR REPLACE INTO users (discord_id, riot_puuid, game_name, tag_line, tier, rank, league_points) VALUES (?, ?, ?, ?, NULL, NULL, NULL)",
                         (target_discord_id, puuid, game_name, tag_line))
+        save_queue_ranks(cur, target_discord_id, ranks)
         con.commit()
         con.close()
+        update_rosters(target_discord_id, ranks)
+        if previous_discord_id is not None:
+            remove_from_rosters(previous_discord_id)
         await ctx.respond(f"ユーザー「{user.display_name}」にRiot ID「{game_name}#{tag_line}」を登録しました！")
     except ApiError as err:
         if err.response.status_code == 404:
@@ -539,14 +1264,16 @@ async def register_by_other(ctx: discord.ApplicationContext, user: discord.Membe
         print(f"!!! An unexpected error occurred in 'register_by_other' command: {e}")
         await ctx.respond("登録中に予期せぬエラーが発生しました。")
 
-@bot.slash_command(name="unregister", description="ボットからあなたの登録情報を削除します。", guild_ids=[DISCORD_GUILD_ID])
+@bot.slash_command(name="unregister", description="ボットからあなたの登録情報を削除します。")
 async def unregister(ctx: discord.ApplicationContext) -> None:
     await ctx.defer()
     try:
         con: sqlite3.Connection = sqlite3.connect(DB_PATH)
         cur: sqlite3.Cursor = con.cursor()
         cur.execute("DELETE FROM users WHERE discord_id = ?", (ctx.author.id,))
+        cur.execute("DELETE FROM queue_ranks WHERE discord_id = ?", (ctx.author.id,))
         con.commit()
+        remove_from_rosters(ctx.author.id)
         if con.total_changes > 0:
             await ctx.respond("あなたの登録情報を削除しました。")
         else:
@@ -557,17 +1284,17 @@ async def unregister(ctx: discord.ApplicationContext) -> None:
         guild: discord.Guild | None = ctx.guild
         if guild:
             member: discord.Member = await guild.fetch_member(ctx.author.id)
-            role_names_to_remove: list[discord.Role | None] = [discord.utils.get(guild.roles, name=role_name) for role_name in RANK_ROLES.values()]
+            role_names_to_remove: list[discord.Role | None] = [discord.utils.get(guild.roles, name=role_name) for rank_roles in QUEUE_RANK_ROLES.values() for role_name in rank_roles.values()]
             await member.remove_roles(*[role for role in role_names_to_remove if role is not None and role in member.roles])
 
     except Exception as e:
         await ctx.respond("登録解除中に予期せぬエラーが発生しました。")
 
-@bot.slash_command(name="ranking", description="サーバー内のLoLランクランキングを表示します。", guild_ids=[DISCORD_GUILD_ID])
-async def ranking(ctx: discord.ApplicationContext) -> None:
+@bot.slash_command(name="ranking", description="サーバー内のLoLランクランキングを表示します。")
+async def ranking(ctx: discord.ApplicationContext, queue: discord.Option(str, "キュー", choices=QUEUE_CHOICES, default=SOLO_QUEUE)) -> None:
     await ctx.defer()
     try:
-        ranking_embed: discord.Embed = await create_ranking_embed()
+        ranking_embed: discord.Embed = await create_ranking_embed(queue, background=False)
         if ranking_embed:
             await ctx.respond(embed=ranking_embed)
         else:
@@ -576,8 +1303,68 @@ async def ranking(ctx: discord.ApplicationContext) -> None:
         print(f"!!! An unexpected error occurred in 'ranking' command: {e}")
         await ctx.respond("ランキングの作成中にエラーが発生しました。")
 
+@bot.slash_command(name="stats", description="サーバー内のランク分布や、あなたの順位を表示します。")
+async def stats(ctx: discord.ApplicationContext, user: discord.Member | None = None, queue: discord.Option(str, "キュー", choices=QUEUE_CHOICES, default=SOLO_QUEUE) = SOLO_QUEUE) -> None:
+    await ctx.defer()
+    roster: Roster = rosters[queue]
+    if not roster.loaded:
+        roster.load()
+    if not len(roster):
+        await ctx.respond("まだ誰も登録されていないか、ランク情報を取得できるユーザーがいません。")
+        return
+
+    embed: discord.Embed = discord.Embed(title=f"📊 ぱぶびゅ！内LoL({QUEUE_NAMES[queue]})ランク統計 📊", color=discord.Color.gold())
+    embed.description = f"ランク情報のあるメンバー: {len(roster)}人"
+
+    distribution: str = "\n".join(f"{TIER_EMOJIS[tier]} {tier}: {count}人" for tier, count in roster.tier_distribution() if count > 0)
+    embed.add_field(name="ティア分布", value=distribution, inline=False)
+    embed.add_field(
+        name="パーセンタイル",
+        value=(
+            f"上位10%: {roster.percentile_label(90)}\n"
+            f"上位25%: {roster.percentile_label(75)}\n"
+            f"中央値: {roster.percentile_label(50)}\n"
+            f"下位25%: {roster.percentile_label(25)}"
+        ),
+        inline=False
+    )
+
+    target: discord.Member | discord.User = user or ctx.author
+    standing: tuple[int, float] | None = roster.standing(target.id)
+    if standing:
+        server_rank, percentile = standing
+        embed.add_field(
+            name=f"{target.display_name}さんの順位",
+            value=f"{server_rank}位 / {len(roster)}人（上位{server_rank / len(roster) * 100:.1f}%、パーセンタイル {percentile:.1f}）",
+            inline=False
+        )
+    else:
+        embed.add_field(name=f"{target.display_name}さんの順位", value="ランク情報がありません。", inline=False)
+
+    await ctx.respond(embed=embed)
+
+@bot.slash_command(name="honor_leaderboard", description="名誉を多く受け取ったメンバーのランキングを表示します。")
+async def honor_leaderboard(ctx: discord.ApplicationContext, period: discord.Option(str, "期間", choices=[discord.OptionChoice(name="今月", value="month"), discord.OptionChoice(name="累計", value="all")], default="month")) -> None:
+    await ctx.defer()
+    period_key: str = datetime.datetime.now(jst).strftime("%Y-%m") if period == "month" else "all"
+    period_label: str = "今月" if period == "month" else "累計"
+
+    con: sqlite3.Connection = sqlite3.connect(DB_PATH)
+    cur: sqlite3.Cursor = con.cursor()
+    cur.execute("SELECT recipient_id, count FROM honor_counts WHERE period = ? ORDER BY count DESC LIMIT ?",
+                (period_key, HONOR_LEADERBOARD_SIZE))
+    top_recipients: list[tuple[int, int]] = cur.fetchall()
+    con.close()
+
+    embed: discord.Embed = discord.Embed(title=f"🎖️ 名誉ランキング（{period_label}） 🎖️", color=discord.Color.gold())
+    if not top_recipients:
+        embed.description = "まだ名誉が贈られていません。"
+    else:
+        embed.description = "\n".join(f"{position}. <@{recipient_id}> — {count}回" for position, (recipient_id, count) in enumerate(top_recipients, start=1))
+    await ctx.respond(embed=embed)
+
 # --- 管理者向けコマンド ---
-@bot.slash_command(name="dashboard", description="登録・登録解除用のダッシュボードを送信します。（管理者向け）", guild_ids=[DISCORD_GUILD_ID])
+@bot.slash_command(name="dashboard", description="登録・登録解除用のダッシュボードを送信します。（管理者向け）")
 @discord.default_permissions(administrator=True)
 async def dashboard(ctx: discord.ApplicationContext, channel: discord.TextChannel | None = None) -> None:
     """
@@ -604,7 +1391,7 @@ async def dashboard(ctx: discord.ApplicationContext, channel: discord.TextChanne
     await target_channel.send(embed=embed, view=DashboardView())
     await ctx.respond("ダッシュボードを送信しました。", ephemeral=True)
 
-@bot.slash_command(name="add_section", description="参加可能なセクションを登録します。（管理者向け）", guild_ids=[DISCORD_GUILD_ID])
+@bot.slash_command(name="add_section", description="参加可能なセクションを登録します。（管理者向け）")
 @discord.default_permissions(administrator=True)
 async def add_section(ctx: discord.ApplicationContext, section_role: discord.Role, notification_channel: discord.TextChannel) -> None:
     await ctx.defer(ephemeral=True)
@@ -620,7 +1407,7 @@ async def add_section(ctx: discord.ApplicationContext, section_role: discord.Rol
         print(f"!!! An unexpected error occurred in 'add_section' command: {e}")
         await ctx.respond("セクションの登録中に予期せぬエラーが発生しました。")
 
-@bot.slash_command(name="remove_section", description="参加可能なセクションを削除します。（管理者向け）", guild_ids=[DISCORD_GUILD_ID])
+@bot.slash_command(name="remove_section", description="参加可能なセクションを削除します。（管理者向け）")
 @discord.default_permissions(administrator=True)
 async def remove_section(ctx: discord.ApplicationContext, section_role: discord.Role) -> None:
     await ctx.defer(ephemeral=True)
@@ -641,7 +1428,7 @@ async def remove_section(ctx: discord.ApplicationContext, section_role: discord.
         await ctx.respond("セクションの削除中に予期せぬエラーが発生しました。")
 
 
-@bot.slash_command(name="remove_user_from_section", description="指定したユーザーをセクションから退出させます。（管理者向け）", guild_ids=[DISCORD_GUILD_ID])
+@bot.slash_command(name="remove_user_from_section", description="指定したユーザーをセクションから退出させます。（管理者向け）")
 @discord.default_permissions(administrator=True)
 async def remove_user_from_section(ctx: discord.ApplicationContext, user: discord.Member, section_role: discord.Role) -> None:
     await ctx.defer(ephemeral=True)
@@ -669,8 +1456,44 @@ async def remove_user_from_section(ctx: discord.ApplicationContext, user: discor
         await ctx.respond("セクションからの退出処理中に予期せぬエラーが発生しました。")
 
 
+@bot.slash_command(name="export", description="登録データをファイルとしてエクスポートします。（管理者向け）")
+@discord.default_permissions(administrator=True)
+async def export(
+    ctx: discord.ApplicationContext,
+    dataset: discord.Option(str, "データ", choices=list(EXPORT_QUERIES)),
+    fmt: discord.Option(str, "形式", name="format", choices=list(EXPORT_FORMATS), default="ndjson")
+) -> None:
+    await ctx.defer(ephemeral=True)
+
+    def write_export_file() -> io.BufferedRandom:
+        # 一時ファイルにチャンクごとにgzip圧縮して書き出し、メモリ使用量を一定に保つ
+        fp: io.BufferedRandom = tempfile.TemporaryFile()
+        with gzip.GzipFile(fileobj=fp, mode="wb") as gz:
+            for chunk in iter_export(dataset, fmt):
+                gz.write(chunk)
+        fp.seek(0)
+        return fp
+
+    try:
+        fp: io.BufferedRandom = await asyncio.to_thread(write_export_file)
+        try:
+            file_size: int = os.fstat(fp.fileno()).st_size
+            filesize_limit: int = ctx.guild.filesize_limit if ctx.guild else 8 * 1024 * 1024
+            if file_size > filesize_limit:
+                await ctx.respond(
+                    f"「{dataset}」のエクスポートは {file_size / 1024 / 1024:.1f}MB あり、Discordの添付上限（{filesize_limit / 1024 / 1024:.0f}MB）を超えています。\n"
+                    f"エクスポート用HTTPエンドポイント（`/export/{dataset}?format={fmt}`、`EXPORT_HTTP_PORT` で有効化）から取得してください。"
+                )
+                return
+            await ctx.respond(f"「{dataset}」をエクスポートしました。", file=discord.File(fp, filename=f"{dataset}.{fmt}.gz"))
+        finally:
+            fp.close()
+    except Exception as e:
+        print(f"!!! An unexpected error occurred in 'export' command: {e}")
+        await ctx.respond("エクスポート中に予期せぬエラーが発生しました。")
+
 # --- デバッグ用コマンド ---
-@bot.slash_command(name="debug_check_ranks_periodically", description="定期的なランクチェックを手動で実行します。（デバッグ用）", guild_ids=[DISCORD_GUILD_ID])
+@bot.slash_command(name="debug_check_ranks_periodically", description="定期的なランクチェックを手動で実行します。（デバッグ用）")
 @discord.default_permissions(administrator=True)
 async def debug_check_ranks_periodically(ctx: discord.ApplicationContext) -> None:
     await ctx.defer(ephemeral=True)
@@ -681,7 +1504,7 @@ async def debug_check_ranks_periodically(ctx: discord.ApplicationContext) -> Non
     except Exception as e:
         await ctx.followup.send(f"処理中にエラーが発生しました: {e}")
 
-@bot.slash_command(name="debug_rank_all_iron", description="登録者全員のランクをIron IVに設定します。（デバッグ用）", guild_ids=[DISCORD_GUILD_ID])
+@bot.slash_command(name="debug_rank_all_iron", description="登録者全員のランクをIron IVに設定します。（デバッグ用）")
 @discord.default_permissions(administrator=True)
 async def debug_rank_all_iron(ctx: discord.ApplicationContext) -> None:
     await ctx.defer(ephemeral=True)
@@ -691,13 +1514,17 @@ async def debug_rank_all_iron(ctx: discord.ApplicationContext) -> None:
         # 全ユーザーのランク情報を更新
         cur.execute("UPDATE users SET tier = 'IRON', rank = 'IV', league_points = 0")
         count: int = cur.rowcount
+        cur.execute("DELETE FROM queue_ranks WHERE queue_type = ?", (SOLO_QUEUE,))
+        cur.execute("INSERT INTO queue_ranks (discord_id, queue_type, tier, rank, league_points) SELECT discord_id, ?, tier, rank, league_points FROM users",
+                    (SOLO_QUEUE,))
         con.commit()
         con.close()
+        rosters[SOLO_QUEUE].load()
         await ctx.respond(f"{count}人のユーザーのランクをIron IVに設定しました。")
     except Exception as e:
         await ctx.respond(f"処理中にエラーが発生しました: {e}")
 
-@bot.slash_command(name="debug_modify_rank", description="特定のユーザーのランクを強制的に変更します。（デバッグ用）", guild_ids=[DISCORD_GUILD_ID])
+@bot.slash_command(name="debug_modify_rank", description="特定のユーザーのランクを強制的に変更します。（デバッグ用）")
 @discord.default_permissions(administrator=True)
 async def debug_modify_rank(ctx: discord.ApplicationContext, user: discord.Member, tier: str, rank: str, league_points: int) -> None:
     await ctx.defer(ephemeral=True)
@@ -715,10 +1542,14 @@ async def debug_modify_rank(ctx: discord.ApplicationContext, user: discord.Membe
                     (tier.upper(), rank.upper(), league_points, user.id))
 
         count: int = cur.rowcount
+        if count > 0:
+            cur.execute("INSERT OR REPLACE INTO queue_ranks (discord_id, queue_type, tier, rank, league_points) VALUES (?, ?, ?, ?, ?)",
+                        (user.id, SOLO_QUEUE, tier.upper(), rank.upper(), league_points))
         con.commit()
         con.close()
 
         if count > 0:
+            rosters[SOLO_QUEUE].update(user.id, {"tier": tier.upper(), "rank": rank.upper(), "leaguePoints": league_points})
             await ctx.respond(f"ユーザー「{user.display_name}」のランクを {tier.upper()} {rank.upper()} {league_points}LP に設定しました。")
         else:
             await ctx.respond(f"ユーザー「{user.display_name}」は見つかりませんでした。先に/registerで登録してください。")
@@ -726,108 +1557,257 @@ async def debug_modify_rank(ctx: discord.ApplicationContext, user: discord.Membe
     except Exception as e:
         await ctx.respond(f"処理中にエラーが発生しました: {e}")
 
+@bot.slash_command(name="debug_loop_lag", description="イベントループの遅延と停止記録を表示します。（デバッグ用）")
+@discord.default_permissions(administrator=True)
+async def debug_loop_lag(ctx: discord.ApplicationContext) -> None:
+    await ctx.defer(ephemeral=True)
+    lines: list[str] = [
+        f"現在の遅延: {loop_watchdog.last_lag * 1000:.1f}ms / 最大遅延: {loop_watchdog.max_lag * 1000:.1f}ms",
+        f"停止回数（{loop_watchdog.threshold * 1000:.0f}ms以上）: {loop_watchdog.stall_count}回",
+    ]
+    for stall in loop_watchdog.worst_stalls():
+        # スタックは末尾（ループを塞いでいた箇所）のみ表示する
+        stack_tail: str = "\n".join(stall['stack'].strip().splitlines()[-6:])
+        lines.append(f"**{stall['lag']:.3f}s** ({stall['at'].astimezone(jst):%m/%d %H:%M:%S})\n```\n{stack_tail}\n```")
+
+    message: str = ""
+    for line in lines:
+        if len(message) + len(line) + 1 > 1900:
+            break
+        message += line + "\n"
+    await ctx.respond(message)
+
 # --- バックグラウンドタスク ---
 jst: datetime.timezone = datetime.timezone(datetime.timedelta(hours=9))
-@tasks.loop(time=datetime.time(hour=12, minute=0, tzinfo=jst))
-async def check_ranks_periodically() -> None:
-    print("--- Starting periodic rank check ---")
-
-    channel: discord.TextChannel | discord.VoiceChannel | discord.Thread | None = bot.get_channel(NOTIFICATION_CHANNEL_ID)
+_refresh_lock: asyncio.Lock = asyncio.Lock()
 
+def start_refresh_run() -> str:
+    """新しいランクチェックのrunを作成し、中断されたままの古いrunは破棄します。"""
+    run_id: str = uuid.uuid4().hex
     con: sqlite3.Connection = sqlite3.connect(DB_PATH)
     cur: sqlite3.Cursor = con.cursor()
-    cur.execute("SELECT discord_id, riot_puuid, tier, rank, game_name, tag_line FROM users")
-    registered_users: list[tuple[int, str, str | None, str | None, str, str]] = cur.fetchall()
-    if not registered_users:
-        con.close()
-        return
+    cur.execute("UPDATE refresh_runs SET status = 'abandoned' WHERE status = 'running'")
+    cur.execute("INSERT INTO refresh_runs (run_id, status, started_at, last_discord_id) VALUES (?, 'running', ?, NULL)",
+                (run_id, datetime.datetime.now(jst).isoformat()))
+    con.commit()
+    con.close()
+    return run_id
 
-    if not channel:
-        print(f"Error: Notification channel with ID {NOTIFICATION_CHANNEL_ID} not found.")
-        con.close()
-        return
+def get_interrupted_run() -> tuple[str, int | None] | None:
+    """完了していないrunがあれば (run_id, 最後に処理したdiscord_id) を返します。"""
+    con: sqlite3.Connection = sqlite3.connect(DB_PATH)
+    cur: sqlite3.Cursor = con.cursor()
+    cur.execute("SELECT run_id, last_discord_id FROM refresh_runs WHERE status = 'running' ORDER BY started_at DESC LIMIT 1")
+    result: tuple[str, int | None] | None = cur.fetchone()
+    con.close()
+    return result
+
+async def sync_rank_roles(guild: discord.Guild, member: discord.Member, ranks: dict[str, dict[str, Any]]) -> None:
+    # --- ランク連動ロール処理（キューごと） ---
+    for queue_type, rank_roles in QUEUE_RANK_ROLES.items():
+        queue_rank_info: dict[str, Any] | None = ranks.get(queue_type)
+        current_rank_tier: str | None = queue_rank_info['tier'].upper() if queue_rank_info else None
+
+        # 現在のユーザーが持っているランクロールを確認
+        current_rank_role: discord.Role | None = None
+        for role_name in rank_roles.values():
+            role: discord.Role | None = discord.utils.get(guild.roles, name=role_name)
+            if role and role in member.roles:
+                current_rank_role = role
+                break
+
+        # 新しいランクに対応するロールを取得
+        new_rank_role: discord.Role | None = None
+        if current_rank_tier and current_rank_tier in rank_roles:
+            new_rank_role = discord.utils.get(guild.roles, name=rank_roles[current_rank_tier])
+
+        # ロールの変更が必要な場合のみ処理
+        if current_rank_role != new_rank_role:
+            # 古いランクロールを削除（存在する場合）
+            if current_rank_role:
+                await outbound.background(member.remove_roles, current_rank_role)
+
+            # 新しいランクロールを追加（存在する場合）
+            if new_rank_role:
+                await outbound.background(member.add_roles, new_rank_role)
+
+async def run_rank_refresh(run_id: str, last_discord_id: int | None) -> None:
+    """
+    ランクチェック本体。1人処理するごとにコミットしてチェックポイントを記録するため、
+    途中で中断しても last_discord_id より後のユーザーと失敗したユーザーだけを再処理すれば再開できます。
+    """
+    # 通知チャンネルが見つからなくてもランク更新とチェックポイントの記録は行う（チャンネルは通知時にだけ使う）
+    guild: discord.Guild | None = bot.get_guild(DISCORD_GUILD_ID)
+    if not guild:
+        print(f"Error: Guild with ID {DISCORD_GUILD_ID} not found.")
 
-    promoted_users: list[dict[str, Any]] = []
-    for discord_id, puuid, old_tier, old_rank, game_name, tag_line in registered_users:
+    con: sqlite3.Connection = sqlite3.connect(DB_PATH)
+    cur: sqlite3.Cursor = con.cursor()
+    # 未処理のユーザーと、このrunで失敗したユーザーのみを対象にする
+    cur.execute('''
+        SELECT discord_id, riot_puuid, tier, rank, game_name, tag_line FROM users
+        WHERE ? IS NULL OR discord_id > ? OR discord_id IN (SELECT discord_id FROM refresh_run_failures WHERE run_id = ?)
+        ORDER BY discord_id
+    ''', (last_discord_id, last_discord_id, run_id))
+    target_users: list[tuple[int, str, str | None, str | None, str, str]] = cur.fetchall()
+    print(f"Run {run_id}: {len(target_users)} users to process")
+    has_registered_users: bool = cur.execute("SELECT 1 FROM users LIMIT 1").fetchone() is not None
+
+    for discord_id, puuid, old_tier, old_rank, game_name, tag_line in target_users:
+        # Riot API・Discordへの通信を先に済ませ、DBへの書き込みは最後にまとめて行う
+        # （awaitの間に書き込みトランザクションを開いたままにしないため）
+        new_ranks: dict[str, dict[str, Any]] | None = None
+        error: str | None = None
         try:
-            new_rank_info: dict[str, Any] | None = get_rank_by_puuid(puuid)
-            guild: discord.Guild | None = channel.guild
-            if not guild:
-                continue
-            member: discord.Member | None = await guild.fetch_member(discord_id)
-            if not member: continue
+            new_ranks = get_ranks_by_puuid(puuid)
+            if guild:
+                member: discord.Member = await outbound.background(guild.fetch_member, discord_id)
+                await sync_rank_roles(guild, member, new_ranks)
+            else:
+                # サーバーを取得できない場合はロールを同期できないため、失敗として記録して再開時に再処理する
+                new_ranks = None
+                error = f"Guild with ID {DISCORD_GUILD_ID} not found"
+
+        except discord.NotFound:
+            print(f"User with ID {discord_id} not found in the server. Skipping.")
+            new_ranks = None
+        except Exception as e:
+            print(f"Error processing user {discord_id}: {e}")
+            new_ranks = None
+            error = str(e)
 
-            # --- データベース更新 ---
+        # --- データベース更新・チェックポイント記録（awaitを挟まずにすぐコミットする） ---
+        if new_ranks is not None:
+            new_rank_info: dict[str, Any] | None = new_ranks.get(SOLO_QUEUE)
             if new_rank_info:
                 cur.execute("UPDATE users SET tier = ?, rank = ?, league_points = ? WHERE discord_id = ?",
                             (new_rank_info['tier'], new_rank_info['rank'], new_rank_info['leaguePoints'], discord_id))
             else:
                 cur.execute("UPDATE users SET tier = NULL, rank = NULL, league_points = NULL WHERE discord_id = ?", (discord_id,))
+            save_queue_ranks(cur, discord_id, new_ranks)
 
             # --- ランクアップ判定 ---
             if new_rank_info and old_tier and old_rank:
                 old_value: int = rank_to_value(old_tier, old_rank, 0)
                 new_value: int = rank_to_value(new_rank_info['tier'], new_rank_info['rank'], 0)
                 if new_value > old_value:
-                    promoted_users.append({
-                        "member": member,
-                        "game_name": game_name,
-                        "tag_line": tag_line,
-                        "old_tier": old_tier,
-                        "old_rank": old_rank,
-                        "new_tier": new_rank_info['tier'],
-                        "new_rank": new_rank_info['rank']
-                    })
-
-            # --- ランク連動ロール処理 ---
-            current_rank_tier: str | None = new_rank_info['tier'].upper() if new_rank_info else None
-
-            # 現在のユーザーが持っているランクロールを確認
-            current_rank_role: discord.Role | None = None
-            for role_name in RANK_ROLES.values():
-                role: discord.Role | None = discord.utils.get(guild.roles, name=role_name)
-                if role and role in member.roles:
-                    current_rank_role = role
-                    break
-
-            # 新しいランクに対応するロールを取得
-            new_rank_role: discord.Role | None = None
-            if current_rank_tier and current_rank_tier in RANK_ROLES:
-                new_rank_role = discord.utils.get(guild.roles, name=RANK_ROLES[current_rank_tier])
-
-            # ロールの変更が必要な場合のみ処理
-            if current_rank_role != new_rank_role:
-                # 古いランクロールを削除（存在する場合）
-                if current_rank_role:
-                    await member.remove_roles(current_rank_role)
-
-                # 新しいランクロールを追加（存在する場合）
-                if new_rank_role:
-                    await member.add_roles(new_rank_role)
-
-        except discord.NotFound:
-             print(f"User with ID {discord_id} not found in the server. Skipping.")
-             continue
-        except Exception as e:
-            print(f"Error processing user {discord_id}: {e}")
-            continue
+                    # 通知はrun完了後に行うため、中断に備えてDBに記録しておく
+                    cur.execute("INSERT OR REPLACE INTO refresh_run_promotions (run_id, discord_id, game_name, tag_line, old_tier, old_rank, new_tier, new_rank) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                (run_id, discord_id, game_name, tag_line, old_tier, old_rank, new_rank_info['tier'], new_rank_info['rank']))
 
+        if error is None:
+            cur.execute("DELETE FROM refresh_run_failures WHERE run_id = ? AND discord_id = ?", (run_id, discord_id))
+        else:
+            cur.execute("INSERT OR REPLACE INTO refresh_run_failures (run_id, discord_id, error) VALUES (?, ?, ?)",
+                        (run_id, discord_id, error))
+        # 失敗したユーザーの再試行ではlast_discord_idを巻き戻さない
+        cur.execute("UPDATE refresh_runs SET last_discord_id = MAX(IFNULL(last_discord_id, ?), ?) WHERE run_id = ?",
+                    (discord_id, discord_id, run_id))
+        con.commit()
+        if new_ranks is not None:
+            update_rosters(discord_id, new_ranks)
+
+    cur.execute("SELECT COUNT(*) FROM refresh_run_failures WHERE run_id = ?", (run_id,))
+    failed_count: int = cur.fetchone()[0]
+    if failed_count:
+        print(f"Run {run_id}: {failed_count} users failed (see refresh_run_failures)")
+
+    cur.execute("SELECT discord_id, game_name, tag_line, old_tier, old_rank, new_tier, new_rank FROM refresh_run_promotions WHERE run_id = ?", (run_id,))
+    promoted_users: list[tuple[int, str, str, str, str, str, str]] = cur.fetchall()
+    # 通知の二重送信を避けるため、通知前にrunを完了扱いにする
+    cur.execute("UPDATE refresh_runs SET status = 'completed', finished_at = ? WHERE run_id = ?",
+                (datetime.datetime.now(jst).isoformat(), run_id))
+    cur.execute("DELETE FROM refresh_run_promotions WHERE run_id = ?", (run_id,))
     con.commit()
     con.close()
 
+    if not has_registered_users:
+        return
+
+    channel: discord.TextChannel | discord.VoiceChannel | discord.Thread | None = bot.get_channel(NOTIFICATION_CHANNEL_ID)
+    if not channel:
+        print(f"Error: Notification channel with ID {NOTIFICATION_CHANNEL_ID} not found.")
+        return
+
     # --- 定期ランキング速報処理 ---
-    if channel:
-        ranking_embed: discord.Embed = await create_ranking_embed()
-        if ranking_embed:
-            await channel.send("【定期ランキング速報】", embed=ranking_embed)
+    ranking_embed: discord.Embed = await create_ranking_embed()
+    if ranking_embed:
+        await outbound.background(channel.send, "【定期ランキング速報】", embed=ranking_embed)
+        set_bot_state('last_ranking_digest', ranking_digest())
 
     # --- ランクアップ通知処理 ---
-    if channel and promoted_users:
-        for user_data in promoted_users:
-            riot_id_full: str = f"{user_data['game_name']}#{user_data['tag_line'].upper()}"
-            await channel.send(f"🎉 **ランクアップ！** 🎉\nおめでとうございます、{user_data['member'].mention}さん ({riot_id_full})！\n**{user_data['old_tier']} {user_data['old_rank']}** → **{user_data['new_tier']} {user_data['new_rank']}** に昇格しました！")
+    for discord_id, game_name, tag_line, old_tier, old_rank, new_tier, new_rank in promoted_users:
+        riot_id_full: str = f"{game_name}#{tag_line.upper()}"
+        await outbound.background(channel.send, f"🎉 **ランクアップ！** 🎉\nおめでとうございます、<@{discord_id}>さん ({riot_id_full})！\n**{old_tier} {old_rank}** → **{new_tier} {new_rank}** に昇格しました！")
+
+async def resume_interrupted_refresh() -> None:
+    interrupted_run: tuple[str, int | None] | None = get_interrupted_run()
+    if not interrupted_run:
+        return
+    run_id, last_discord_id = interrupted_run
+    async with _refresh_lock:
+        print(f"--- Resuming interrupted rank check (run {run_id}, after discord_id {last_discord_id}) ---")
+        await run_rank_refresh(run_id, last_discord_id)
+        print("--- Resumed rank check finished ---")
 
-    print("--- Periodic rank check finished ---")
+@tasks.loop(time=datetime.time(hour=12, minute=0, tzinfo=jst))
+async def check_ranks_periodically() -> None:
+    async with _refresh_lock:
+        print("--- Starting periodic rank check ---")
+        run_id: str = start_refresh_run()
+        await run_rank_refresh(run_id, None)
+        print("--- Periodic rank check finished ---")
+
+_name_sync_cursor: int = 0 # 次回のRiot ID同期をこのdiscord_idより後から始める
+
+@tasks.loop(minutes=NAME_SYNC_INTERVAL_MINUTES)
+async def sync_riot_ids() -> None:
+    """
+    Riot IDの変更（リネーム）をaccount-v1のby-puuidで少しずつ反映します。
+    ランクチェックとAPIの利用枠を取り合わないよう、ランクチェックの実行中は何もしません。
+    """
+    global _name_sync_cursor
+    if _refresh_lock.locked():
+        return
+
+    con: sqlite3.Connection = sqlite3.connect(DB_PATH)
+    cur: sqlite3.Cursor = con.cursor()
+    cur.execute("SELECT discord_id, riot_puuid, game_name, tag_line FROM users WHERE discord_id > ? ORDER BY discord_id LIMIT ?",
+                (_name_sync_cursor, NAME_SYNC_BATCH_SIZE))
+    target_users: list[tuple[int, str, str, str]] = cur.fetchall()
+    if len(target_users) < NAME_SYNC_BATCH_SIZE:
+        # 末尾まで到達したら次回は先頭から
+        _name_sync_cursor = 0
+
+    for discord_id, puuid, game_name, tag_line in target_users:
+        if _refresh_lock.locked():
+            break
+        try:
+            account_info: dict[str, Any] = await asyncio.to_thread(get_riot_watcher().account.by_puuid, my_region_for_account, puuid)
+        except ApiError as err:
+            if err.response.status_code == 429:
+                print("Rate limit exceeded during Riot ID sync. Stopping this batch.")
+                break
+            print(f"API Error in sync_riot_ids for PUUID {puuid}: {err}")
+            account_info = {}
+        except Exception as e:
+            print(f"An unexpected error occurred in sync_riot_ids for PUUID {puuid}: {e}")
+            account_info = {}
+
+        if len(target_users) == NAME_SYNC_BATCH_SIZE:
+            _name_sync_cursor = discord_id
+
+        new_game_name: str | None = account_info.get('gameName')
+        new_tag_line: str | None = account_info.get('tagLine')
+        # 名前が変わったユーザーのみ更新する
+        if new_game_name and new_tag_line and (new_game_name, new_tag_line.upper()) != (game_name, tag_line):
+            cur.execute("UPDATE users SET game_name = ?, tag_line = ? WHERE discord_id = ?", (new_game_name, new_tag_line.upper(), discord_id))
+            con.commit()
+            print(f"Riot ID updated for user {discord_id}: {game_name}#{tag_line} -> {new_game_name}#{new_tag_line.upper()}")
+
+        await asyncio.sleep(NAME_SYNC_REQUEST_INTERVAL)
+
+    con.close()
 
 @bot.event
 async def on_voice_state_update(member: discord.Member, before: discord.VoiceState, after: discord.VoiceState) -> None:
@@ -840,15 +1820,16 @@ async def on_voice_state_update(member: discord.Member, before: discord.VoiceSta
             return
         try:
             channel_name: str = "👀｜ランク戦見守り部屋" if after.channel.id == RANK_GAME_CHANNEL_ID else "".join(random.choices(string.ascii_letters + string.digits, k=5))
-            new_channel: discord.VoiceChannel = await guild.create_voice_channel(
+            new_channel: discord.VoiceChannel = await outbound.background(
+                guild.create_voice_channel,
                 name=channel_name,
                 category=category,
                 user_limit=0,  # 0=制限なし
             )
             if after.channel.id == RANK_GAME_CHANNEL_ID:
-                await new_channel.set_permissions(guild.default_role, stream=False)
-                await new_channel.set_permissions(member, stream=True)
-            await member.move_to(new_channel)
+                await outbound.background(new_channel.set_permissions, guild.default_role, stream=False)
+                await outbound.background(new_channel.set_permissions, member, stream=True)
+            await outbound.background(member.move_to, new_channel)
         except Exception as e:
             print(f"!!! ボイスチャンネル作成エラー: {e}")
 
@@ -858,11 +1839,11 @@ async def on_voice_state_update(member: discord.Member, before: discord.VoiceSta
             return
         if len(before.channel.members) == 0:
             try:
-                await before.channel.delete()
+                await outbound.background(before.channel.delete)
             except Exception as e:
                 print(f"!!! 空チャンネル削除エラー: {e}")
 
 # --- Botの起動 ---
 if __name__ == '__main__':
-    setup_database()
-    bot.run(DISCORD_TOKEN)
+    app: discord.Bot = create_app()
+    app.run(DISCORD_TOKEN)